@@ -155,6 +155,11 @@ class Shipment(Base):
     rejection_reason = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    to_branch = relationship("Branch")
+    items = relationship(
+        "ShipmentItem", back_populates="shipment", order_by="ShipmentItem.id"
+    )
+
 class ShipmentItem(Base):
     __tablename__ = "shipment_items"
 
@@ -165,6 +170,8 @@ class ShipmentItem(Base):
     item_name = Column(String, nullable=False)
     quantity = Column(Integer, nullable=False)
 
+    shipment = relationship("Shipment", back_populates="items")
+
 class Notification(Base):
     __tablename__ = "notifications"
 
@@ -1,7 +1,7 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Query, Response, Request, APIRouter
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Response, Request, APIRouter, BackgroundTasks
 from starlette.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm import Session, joinedload, selectinload
 from sqlalchemy import (
     text,
     inspect,
@@ -43,18 +43,18 @@ from database import (
 from schemas import *
 from typing import List, Optional, Iterable, Callable, Literal
 from datetime import datetime, date, timedelta, timezone, time
-from zoneinfo import ZoneInfo
 import uuid
 import json
 import os
 from pydantic import ValidationError, BaseModel, conint, conlist
-from services.stock import get_available_qty, decrement_stock, ItemType
+from services.stock import decrement_stock_many, ItemType
 import traceback
 import logging
 import re
 from io import BytesIO
 from utils.waybill_html import render_waybill_html
-from utils.waybill_pdf import render_waybill_pdf
+from utils.waybill_pdf import render_waybill_pdf, safe_filename
+from utils.tz import ALMATY as ALMATY_TZ, UTC as UTC_TZ
 from services.shipments import load_waybill_payload
 try:
     from openpyxl import Workbook
@@ -66,8 +66,11 @@ except ImportError:  # pragma: no cover
 logger = logging.getLogger(__name__)
 log = logging.getLogger("reports")
 
-ALMATY_TZ = ZoneInfo("Asia/Almaty")
+_DISPLAY_DT_FORMAT = "%d.%m.%Y %H:%M"
 MAIN_BRANCH_ID_ENV = os.getenv("MAIN_BRANCH_ID")
+# Render each new shipment's waybill in the background so the first
+# download is a cache hit. Off by default: the cache is per process.
+WAYBILL_PRERENDER = os.getenv("WAYBILL_PRERENDER", "").lower() in ("1", "true", "yes")
 
 
 def to_almaty(dt: datetime | str | None) -> str:
@@ -79,8 +82,8 @@ def to_almaty(dt: datetime | str | None) -> str:
         except Exception:
             return dt
     if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=ZoneInfo("UTC"))
-    return dt.astimezone(ALMATY_TZ).strftime("%d.%m.%Y %H:%M")
+        dt = dt.replace(tzinfo=UTC_TZ)
+    return dt.astimezone(ALMATY_TZ).strftime(_DISPLAY_DT_FORMAT)
 
 
 def _parse_date_ymd(s: str | None):
@@ -127,7 +130,7 @@ def _to_local_str(dt: datetime | None) -> str:
         return ""
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(ALMATY_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    return dt.astimezone(ALMATY_TZ).replace(tzinfo=None).isoformat(" ", "seconds")
 
 
 def humanize_items(raw) -> str:
@@ -1100,15 +1103,15 @@ async def create_transfers(batch: BatchTransferCreate, db: Session = Depends(get
 # Shipment endpoints
 @app.get("/shipments")
 async def get_shipments(branch_id: Optional[str] = None, db: Session = Depends(get_db)):
+    query = db.query(DBShipment).options(selectinload(DBShipment.items))
     if branch_id and branch_id != "null" and branch_id != "undefined":
-        shipments = db.query(DBShipment).filter(DBShipment.to_branch_id == branch_id).all()
+        shipments = query.filter(DBShipment.to_branch_id == branch_id).all()
     else:
-        shipments = db.query(DBShipment).all()
+        shipments = query.all()
     
     result = []
     for shipment in shipments:
-        # Get shipment items
-        items = db.query(DBShipmentItem).filter(DBShipmentItem.shipment_id == shipment.id).all()
+        items = shipment.items
         
         shipment_data = {
             "id": shipment.id,
@@ -1150,7 +1153,7 @@ async def get_dispensing_record_detail(record_id: str, db: Session = Depends(get
         raise HTTPException(status_code=404, detail="Record not found")
     rec, branch = record
     items = db.query(DBDispensingItem).filter(DBDispensingItem.record_id == record_id).all()
-    tz = ZoneInfo("Asia/Almaty")
+    tz = ALMATY_TZ
     dt = rec.date
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
@@ -1172,8 +1175,24 @@ async def get_dispensing_record_detail(record_id: str, db: Session = Depends(get
     }
     return {"data": data}
 
+def _prerender_waybill(shipment_id: str) -> None:
+    # The PDF cache is keyed by payload content, which does not change after
+    # creation, so rendering here makes the first download a cache hit.
+    try:
+        with SessionLocal() as db:
+            payload = load_waybill_payload(db, shipment_id)
+        if payload:
+            render_waybill_pdf(payload)
+    except Exception:
+        logger.exception("waybill prerender failed for %s", shipment_id)
+
+
 @app.post("/shipments")
-async def create_shipment(shipment_data: dict, db: Session = Depends(get_db)):
+async def create_shipment(
+    shipment_data: dict,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+):
     try:
         shipment_id = str(uuid.uuid4())
         
@@ -1240,6 +1259,8 @@ async def create_shipment(shipment_data: dict, db: Session = Depends(get_db)):
         db.add(notification)
         
         db.commit()
+        if WAYBILL_PRERENDER:
+            background_tasks.add_task(_prerender_waybill, shipment_id)
         return {"message": "Shipment created successfully"}
     except Exception as e:
         db.rollback()
@@ -1363,7 +1384,7 @@ def download_shipment_waybill(
         pdf,
         media_type="application/pdf",
         headers={
-            "Content-Disposition": f'attachment; filename=waybill_{payload["id"]}.pdf'
+            "Content-Disposition": f'attachment; filename=waybill_{safe_filename(payload["id"])}.pdf'
         },
     )
 
@@ -1495,18 +1516,19 @@ async def create_dispensing_record(payload: dict, db: Session = Depends(get_db))
             if not patient or not employee:
                 raise HTTPException(status_code=404, detail="Patient or employee not found")
 
-            for itm in items:
-                available, name = get_available_qty(
-                    db, str(branch_id), itm["type"], str(itm["item_id"])
+            try:
+                names = decrement_stock_many(
+                    db,
+                    str(branch_id),
+                    [
+                        (itm["type"], str(itm["item_id"]), itm["quantity"])
+                        for itm in items
+                    ],
                 )
-                if itm["quantity"] > available:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=(
-                            f"Not enough stock for {itm['type'].value}:{itm['item_id']} (available {available}, requested {itm['quantity']})"
-                        ),
-                    )
-                itm["item_name"] = name
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            for itm in items:
+                itm["item_name"] = names[(itm["type"], str(itm["item_id"]))]
 
             db_record = DBDispensingRecord(
                 id=str(uuid.uuid4()),
@@ -1532,13 +1554,6 @@ async def create_dispensing_record(payload: dict, db: Session = Depends(get_db))
                         quantity=itm["quantity"],
                     )
                 )
-                decrement_stock(
-                    db,
-                    str(branch_id),
-                    itm["type"],
-                    str(itm["item_id"]),
-                    itm["quantity"],
-                )
 
             return {
                 "id": db_record.id,
@@ -1803,6 +1818,7 @@ async def get_incoming_report(
 
         shipments = (
             db.query(DBShipment)
+            .options(selectinload(DBShipment.items))
             .filter(
                 DBShipment.to_branch_id == branch_id,
                 DBShipment.status == "accepted",
@@ -1814,14 +1830,9 @@ async def get_incoming_report(
 
         data = []
         for s in shipments:
-            items = (
-                db.query(DBShipmentItem)
-                .filter(DBShipmentItem.shipment_id == s.id)
-                .all()
-            )
             items_data = [
                 {"type": it.item_type, "name": it.item_name, "quantity": it.quantity}
-                for it in items
+                for it in s.items
             ]
             data.append(
                 {
@@ -2328,7 +2339,7 @@ def _to_almaty_str(dt_value) -> str:
 
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(ALMATY_TZ).strftime("%Y-%m-%d %H:%M:%S")
+    return dt.astimezone(ALMATY_TZ).replace(tzinfo=None).isoformat(" ", "seconds")
 
 
 def _render_xlsx(headers: list[str], rows: list[list[str]], sheet_name: str = "Sheet1") -> bytes:
@@ -2588,7 +2599,7 @@ def build_wh_arrivals_json(
 def build_wh_dispatches_json(
     db, start: datetime | None, end: datetime | None
 ) -> dict:
-    q = db.query(DBShipment)
+    q = db.query(DBShipment).options(selectinload(DBShipment.items))
 
     date_col = getattr(DBShipment, "created_at")
     date_attr = date_col.key
@@ -2602,14 +2613,9 @@ def build_wh_dispatches_json(
 
     json_rows: list[dict] = []
     for r in rows:
-        items = (
-            db.query(DBShipmentItem)
-            .filter(DBShipmentItem.shipment_id == r.id)
-            .all()
-        )
         items_data = [
             {"type": it.item_type, "name": it.item_name, "quantity": it.quantity}
-            for it in items
+            for it in r.items
         ]
         dt = getattr(r, date_attr, None)
         dt_iso = dt.isoformat() if dt else ""
@@ -2950,7 +2956,7 @@ async def get_stock_item_details(
     db: Session = Depends(get_db),
 ):
     try:
-        tz = ZoneInfo("Asia/Almaty")
+        tz = ALMATY_TZ
         if date_to:
             dt_to = datetime.fromisoformat(date_to)
             if dt_to.tzinfo is None:
@@ -3030,7 +3036,7 @@ async def get_calendar_dispensing(
 ):
     """Calendar dispensing endpoint supporting summary and day listing."""
     try:
-        tz = ZoneInfo("Asia/Almaty")
+        tz = ALMATY_TZ
 
         # Aggregate mode: monthly summary
         if aggregate == 1 and start and end:
@@ -3152,7 +3158,7 @@ async def get_calendar_dispensing_day(
 ):
     """Return dispensing details for a specific patient on a given day."""
     try:
-        tz = ZoneInfo("Asia/Almaty")
+        tz = ALMATY_TZ
         day_local = datetime.strptime(date, "%Y-%m-%d").replace(
             tzinfo=tz, hour=0, minute=0, second=0, microsecond=0
         )
@@ -1,54 +1,102 @@
 from __future__ import annotations
 
-from datetime import datetime, timezone
-from typing import Dict, List, Optional
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
 
 from sqlalchemy import select
-from sqlalchemy.orm import Session
-from zoneinfo import ZoneInfo
+from sqlalchemy.orm import Session, joinedload, raiseload
 
-from database import Branch as DBBranch
 from database import Shipment as DBShipment
 from database import ShipmentItem as DBShipmentItem
+from utils.tz import ALMATY as ALMATY_TZ
+from utils.tz import UTC as UTC_TZ
+from utils.waybill_types import WaybillItem, WaybillPayload
 
-ALMATY_TZ = ZoneInfo("Asia/Almaty")
+# Only the branch is loaded through the ORM (items are fetched as plain
+# columns); any other relationship access raises instead of lazy-loading.
+_WAYBILL_OPTIONS = (
+    joinedload(DBShipment.to_branch),
+    raiseload("*"),
+)
 
 
 def _fmt_dt(dt: Optional[datetime]) -> str:
     if not dt:
         return ""
     if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(ALMATY_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        dt = dt.replace(tzinfo=UTC_TZ)
+    # Same text as strftime("%Y-%m-%d %H:%M:%S"), without reparsing a format.
+    return dt.astimezone(ALMATY_TZ).replace(tzinfo=None).isoformat(" ", "seconds")
 
 
-def load_waybill_payload(db: Session, shipment_id: str) -> Optional[Dict[str, object]]:
-    shipment = db.get(DBShipment, shipment_id)
-    if not shipment:
-        return None
+def _waybill_payload(
+    shipment: DBShipment, rows: List[WaybillItem]
+) -> WaybillPayload:
+    return {
+        "id": str(shipment.id),
+        "created_at": _fmt_dt(getattr(shipment, "created_at", None)),
+        "from_branch": "Главный склад",
+        "to_branch": getattr(shipment.to_branch, "name", "—"),
+        "items": rows,
+        "total_quantity": sum(row["quantity"] for row in rows),
+    }
 
-    to_branch = db.get(DBBranch, getattr(shipment, "to_branch_id"))
 
-    items: List[DBShipmentItem] = (
+def _waybill_rows(db: Session, ids: List[str]) -> Dict[str, List[WaybillItem]]:
+    result = db.execute(
+        select(
+            DBShipmentItem.shipment_id,
+            DBShipmentItem.item_name,
+            DBShipmentItem.quantity,
+        )
+        .where(DBShipmentItem.shipment_id.in_(ids))
+        .order_by(DBShipmentItem.id)
+    ).all()
+    rows: Dict[str, List[WaybillItem]] = {}
+    for shipment_id, name, quantity in result:
+        rows.setdefault(shipment_id, []).append(
+            {"name": name, "quantity": int(quantity or 0)}
+        )
+    return rows
+
+
+def load_waybill_payloads(
+    db: Session, shipment_ids: Iterable[str]
+) -> Dict[str, WaybillPayload]:
+    """Load waybill payloads for many shipments with a fixed number of queries."""
+    ids = list(dict.fromkeys(shipment_ids))
+    if not ids:
+        return {}
+    shipments = (
         db.execute(
-            select(DBShipmentItem)
-            .where(DBShipmentItem.shipment_id == shipment_id)
-            .order_by(DBShipmentItem.id)
+            select(DBShipment)
+            .options(*_WAYBILL_OPTIONS)
+            .where(DBShipment.id.in_(ids))
         )
+        .unique()
         .scalars()
         .all()
     )
-
-    rows = [
-        {"name": item.item_name, "quantity": int(item.quantity or 0)}
-        for item in items
-    ]
-
+    if not shipments:
+        return {}
+    rows = _waybill_rows(db, [shipment.id for shipment in shipments])
     return {
-        "id": str(shipment.id),
-        "created_at": _fmt_dt(getattr(shipment, "created_at", None)),
-        "from_branch": "Главный склад",
-        "to_branch": getattr(to_branch, "name", "—"),
-        "items": rows,
-        "total_quantity": sum(row["quantity"] for row in rows),
+        str(shipment.id): _waybill_payload(shipment, rows.get(shipment.id, []))
+        for shipment in shipments
     }
+
+
+def load_waybill_payload(db: Session, shipment_id: str) -> Optional[WaybillPayload]:
+    shipment = (
+        db.execute(
+            select(DBShipment)
+            .options(*_WAYBILL_OPTIONS)
+            .where(DBShipment.id == shipment_id)
+        )
+        .unique()
+        .scalar_one_or_none()
+    )
+    if not shipment:
+        return None
+    rows = _waybill_rows(db, [shipment.id])
+    return _waybill_payload(shipment, rows.get(shipment.id, []))
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Optional, Tuple
+from typing import Dict, Iterable, Optional, Tuple
 
 from sqlalchemy import text
 from sqlalchemy.orm import Session
@@ -10,16 +10,37 @@ class ItemType(str, Enum):
     medical_device = "medical_device"
 
 
+_TABLES = {
+    ItemType.medicine: "medicines",
+    ItemType.medical_device: "medical_devices",
+}
+
+# Statements are built once per table instead of per call.
+_SELECT_QTY = {
+    item_type: text(
+        f"SELECT quantity, name FROM {table} WHERE id = :i AND branch_id = :b"
+    )
+    for item_type, table in _TABLES.items()
+}
+_DECREMENT = {
+    item_type: text(
+        f"""
+            UPDATE {table}
+               SET quantity = quantity - :q
+             WHERE id = :i AND branch_id = :b AND quantity >= :q
+            RETURNING quantity
+        """
+    )
+    for item_type, table in _TABLES.items()
+}
+
+
 def get_available_qty(
     db: Session, branch_id: str, item_type: ItemType, item_id: str
 ) -> Tuple[int, Optional[str]]:
     """Return available quantity and item name for given branch and item."""
-    table = "medicines" if item_type == ItemType.medicine else "medical_devices"
     row = db.execute(
-        text(
-            f"SELECT quantity, name FROM {table} WHERE id = :i AND branch_id = :b"
-        ),
-        {"i": item_id, "b": branch_id},
+        _SELECT_QTY[item_type], {"i": item_id, "b": branch_id}
     ).first()
     if not row:
         return 0, None
@@ -29,22 +50,70 @@ def get_available_qty(
 def decrement_stock(
     db: Session, branch_id: str, item_type: ItemType, item_id: str, qty: int
 ) -> None:
-    """Decrement stock atomically; raise ValueError if insufficient."""
+    """Decrement stock atomically; raise ValueError if insufficient.
+
+    This is the canonical stock check: the UPDATE only matches rows with
+    enough quantity, so callers should not pre-read ``get_available_qty``.
+    """
     if qty <= 0:
         return
-    table = "medicines" if item_type == ItemType.medicine else "medical_devices"
     res = db.execute(
-        text(
-            f"""
-            UPDATE {table}
-               SET quantity = quantity - :q
-             WHERE id = :i AND branch_id = :b AND quantity >= :q
-            RETURNING quantity
-        """
-        ),
-        {"i": item_id, "b": branch_id, "q": qty},
+        _DECREMENT[item_type], {"i": item_id, "b": branch_id, "q": qty}
     ).first()
     if not res:
         raise ValueError(
             f"Not enough stock for {item_type}:{item_id}"
         )
+
+
+def decrement_stock_many(
+    db: Session, branch_id: str, ops: Iterable[Tuple[ItemType, str, int]]
+) -> Dict[Tuple[ItemType, str], str]:
+    """Decrement several items with one UPDATE per item table.
+
+    ``ops`` holds ``(item_type, item_id, qty)``; repeated items are summed.
+    Returns item names keyed by ``(item_type, item_id)``. Raises ValueError
+    if any item is missing or short; the caller's transaction must then be
+    rolled back, as rows of the other items may already be updated.
+    """
+    wanted: Dict[ItemType, Dict[str, int]] = {}
+    for item_type, item_id, qty in ops:
+        if qty <= 0:
+            continue
+        per_type = wanted.setdefault(ItemType(item_type), {})
+        per_type[item_id] = per_type.get(item_id, 0) + qty
+
+    names: Dict[Tuple[ItemType, str], str] = {}
+    for item_type, quantities in wanted.items():
+        table = _TABLES[item_type]
+        params: Dict[str, object] = {"b": branch_id}
+        values = []
+        for n, (item_id, qty) in enumerate(quantities.items()):
+            values.append(f"(:i{n}, CAST(:q{n} AS INTEGER))")
+            params[f"i{n}"] = item_id
+            params[f"q{n}"] = qty
+        rows = db.execute(
+            text(
+                f"""
+                UPDATE {table}
+                   SET quantity = {table}.quantity - v.column2
+                  FROM (VALUES {", ".join(values)}) AS v
+                 WHERE {table}.id = v.column1
+                   AND {table}.branch_id = :b
+                   AND {table}.quantity >= v.column2
+                RETURNING {table}.id, {table}.name
+            """
+            ),
+            params,
+        ).all()
+        updated = {row[0]: row[1] for row in rows}
+        for item_id, qty in quantities.items():
+            if item_id not in updated:
+                # The shortfall row was not touched, so this reads its stock.
+                available, _ = get_available_qty(db, branch_id, item_type, item_id)
+                raise ValueError(
+                    f"Not enough stock for {item_type.value}:{item_id} "
+                    f"(available {available}, requested {qty})"
+                )
+            names[(item_type, item_id)] = updated[item_id]
+    return names
@@ -86,6 +86,7 @@ def test_insufficient_stock():
     with pytest.raises(HTTPException) as exc:
         asyncio.run(create_dispensing_record(payload, db=session))
     assert "Not enough stock" in str(exc.value.detail)
+    assert "(available 10, requested 100)" in str(exc.value.detail)
 
 def test_zero_quantity():
     payload = {
@@ -96,3 +97,30 @@ def test_zero_quantity():
     }
     with pytest.raises(HTTPException):
         asyncio.run(create_dispensing_record(payload, db=session))
+
+def test_insufficient_stock_rolls_back_other_items():
+    payload = {
+        "patient_id": "p1",
+        "employee_id": "e1",
+        "branch_id": "b1",
+        "medicines": [{"id": "m1", "quantity": 2}],
+        "medical_devices": [{"id": "d1", "quantity": 6}],
+    }
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(create_dispensing_record(payload, db=session))
+    assert "Not enough stock" in str(exc.value.detail)
+    med_qty, _ = get_available_qty(session, "b1", ItemType.medicine, "m1")
+    assert med_qty == 10
+
+def test_repeated_item_is_summed():
+    payload = {
+        "patient_id": "p1",
+        "employee_id": "e1",
+        "branch_id": "b1",
+        "medicines": [{"id": "m1", "quantity": 6}, {"id": "m1", "quantity": 6}],
+    }
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(create_dispensing_record(payload, db=session))
+    assert "(available 10, requested 12)" in str(exc.value.detail)
+    med_qty, _ = get_available_qty(session, "b1", ItemType.medicine, "m1")
+    assert med_qty == 10
@@ -2,7 +2,7 @@ import os
 import sys
 import asyncio
 from datetime import datetime
-from sqlalchemy import text
+from sqlalchemy import event, text
 import pathlib
 import importlib
 
@@ -17,7 +17,7 @@ os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
 import database
 importlib.reload(database)
 from database import create_tables, SessionLocal, Branch, Shipment, ShipmentItem
-from main import get_incoming_report
+from main import build_wh_dispatches_json, get_incoming_report
 
 create_tables()
 session = SessionLocal()
@@ -49,3 +49,42 @@ def test_incoming_report():
     assert len(entry["items"]) == 2
     names = {i["name"] for i in entry["items"]}
     assert "Тримол" in names and "Шприц 100" in names
+
+
+def _count_queries(fn):
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        result = fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    return result, len(statements)
+
+
+def test_shipment_reports_load_items_in_one_query():
+    session.execute(text("DELETE FROM shipment_items"))
+    session.execute(text("DELETE FROM shipments"))
+    for n in range(5):
+        session.add(Shipment(id=f"s{n}", to_branch_id="b1", status="accepted", created_at=datetime(2024, 1, 10 + n)))
+        session.add(ShipmentItem(id=f"i{n}", shipment_id=f"s{n}", item_type="medicine", item_id="m1", item_name=f"Мед {n}", quantity=n + 1))
+    session.commit()
+    session.expire_all()
+
+    resp, queries = _count_queries(
+        lambda: asyncio.run(get_incoming_report("b1", "2024-01-01", "2024-01-31", db=session))
+    )
+    assert len(resp["data"]) == 5
+    assert all(len(entry["items"]) == 1 for entry in resp["data"])
+    assert queries == 2
+
+    session.expire_all()
+    resp, queries = _count_queries(
+        lambda: build_wh_dispatches_json(session, datetime(2024, 1, 1), datetime(2024, 1, 31))
+    )
+    assert [entry["items"][0]["name"] for entry in resp["data"]] == [f"Мед {n}" for n in range(5)]
+    assert queries == 2
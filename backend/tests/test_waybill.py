@@ -0,0 +1,368 @@
+import asyncio
+import os
+import re
+import sys
+from datetime import datetime, timezone
+from decimal import Decimal
+from zoneinfo import ZoneInfo
+import pathlib
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+from fastapi import BackgroundTasks
+from reportlab.platypus import Paragraph, Table
+from sqlalchemy import select, text
+from sqlalchemy.exc import InvalidRequestError
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+DB_PATH = "./test_waybill.db"
+if os.path.exists(DB_PATH):
+    os.remove(DB_PATH)
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+
+import database
+importlib.reload(database)
+from database import create_tables, SessionLocal, Branch, Shipment, ShipmentItem
+from services.shipments import (
+    DBShipment,
+    _WAYBILL_OPTIONS,
+    load_waybill_payload,
+    load_waybill_payloads,
+)
+import main
+from utils import waybill_pdf
+from utils.waybill_html import render_waybill_html
+from utils.waybill_pdf import (
+    render_waybill_pdf,
+    render_waybill_pdf_fast,
+    render_waybill_pdf_soa,
+    render_waybill_pdf_to,
+    render_waybill_pdfs,
+    safe_filename,
+)
+
+create_tables()
+session = SessionLocal()
+session.add(Branch(id="b1", name="B1", login="b1", password="p"))
+session.commit()
+
+
+@pytest.fixture(autouse=True)
+def seed_shipment():
+    session.execute(text("DELETE FROM shipment_items"))
+    session.execute(text("DELETE FROM shipments"))
+    session.add(Shipment(id="s1", to_branch_id="b1", status="pending", created_at=datetime(2024, 1, 10, 12, 0, 0)))
+    session.add(ShipmentItem(id="i2", shipment_id="s1", item_type="medical_device", item_id="d1", item_name="Шприц 100", quantity=15))
+    session.add(ShipmentItem(id="i1", shipment_id="s1", item_type="medicine", item_id="m1", item_name="Тримол", quantity=20))
+    session.commit()
+    yield
+
+
+def test_load_waybill_payload():
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    assert payload["to_branch"] == "B1"
+    expected = datetime(2024, 1, 10, 12, 0, 0, tzinfo=timezone.utc).astimezone(ZoneInfo("Asia/Almaty"))
+    assert payload["created_at"] == expected.strftime("%Y-%m-%d %H:%M:%S")
+    assert [i["name"] for i in payload["items"]] == ["Тримол", "Шприц 100"]
+    assert payload["total_quantity"] == 35
+
+
+def test_load_waybill_payload_missing():
+    assert load_waybill_payload(SessionLocal(), "nope") is None
+
+
+def test_waybill_options_forbid_lazy_loads():
+    db = SessionLocal()
+    shipment = db.execute(
+        select(DBShipment).options(*_WAYBILL_OPTIONS).where(DBShipment.id == "s1")
+    ).unique().scalar_one()
+    assert shipment.to_branch.name == "B1"
+    with pytest.raises(InvalidRequestError):
+        shipment.items
+
+
+def test_load_waybill_payloads_batch():
+    session.add(Shipment(id="s2", to_branch_id="b1", status="pending", created_at=datetime(2024, 1, 11, 12, 0, 0)))
+    session.add(ShipmentItem(id="i3", shipment_id="s2", item_type="medicine", item_id="m1", item_name="Тест", quantity=5))
+    session.commit()
+
+    payloads = load_waybill_payloads(SessionLocal(), ["s1", "s2", "missing"])
+    assert set(payloads) == {"s1", "s2"}
+    assert payloads["s1"] == load_waybill_payload(SessionLocal(), "s1")
+    assert payloads["s2"]["total_quantity"] == 5
+
+
+def test_waybill_html_escapes_values():
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    payload["to_branch"] = "<script>x</script>"
+    payload["items"][0]["name"] = "A & B"
+    html = render_waybill_html(payload)
+    assert "<script>" not in html
+    assert "&lt;script&gt;x&lt;/script&gt;" in html
+    assert "<td>A &amp; B</td>" in html
+
+
+def test_safe_filename():
+    assert safe_filename("3f2a-11_x") == "3f2a-11_x"
+    assert safe_filename('a b";\r\nЖ') == "a_b_____"
+
+
+def test_render_waybill_pdf():
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    assert render_waybill_pdf(payload).startswith(b"%PDF")
+    assert render_waybill_pdf_fast(payload).startswith(b"%PDF")
+
+
+def test_render_waybill_pdf_cache_miss_uses_caller_payload():
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    del payload["total_quantity"]
+    for row in payload["items"]:
+        row["quantity"] = Decimal(row["quantity"])
+    first = render_waybill_pdf(payload)
+    assert render_waybill_pdf(payload) is first
+
+
+def test_pdf_cache_evicts_by_entries_and_bytes():
+    cache = waybill_pdf._PdfCache(max_entries=2, max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+    cache.put("c", b"1234")
+    assert cache.get("b") is None
+    cache.put("d", b"1234567")
+    assert cache.get("a") is None and cache.get("c") is None
+    assert cache.get("d") == b"1234567"
+    cache.put("e", b"x" * 11)
+    assert cache.get("e") is None and cache.get("d") == b"1234567"
+
+
+def test_waybill_total_defaults_to_item_sum(monkeypatch):
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    del payload["total_quantity"]
+    assert "Всего единиц:</b> 35" in render_waybill_html(payload)
+    assert render_waybill_pdf(payload).startswith(b"%PDF")
+    assert render_waybill_pdf_fast(payload).startswith(b"%PDF")
+    assert "total_quantity" not in payload
+    payload["total_quantity"] = None
+    assert "Всего единиц:</b> 35" in render_waybill_html(payload)
+    _, drawn = _fast_render(monkeypatch, lambda: render_waybill_pdf_fast(payload))
+    assert "Всего позиций: 2, Всего единиц: 35" in drawn
+
+
+def test_render_empty_waybill_pdf(monkeypatch):
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    payload.update(items=[], total_quantity=0)
+    waybill_pdf._CACHE.clear()
+    pdf, drawn = _fast_render(monkeypatch, lambda: render_waybill_pdf(payload))
+    assert pdf.startswith(b"%PDF")
+    assert "Всего позиций: 0, Всего единиц: 0" in drawn
+    assert "Откуда: Главный склад" in drawn
+
+
+def test_render_waybill_pdf_fast_wraps_header(monkeypatch):
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    payload["to_branch"] = "Филиал " + "очень длинное название " * 12
+    _, drawn = _fast_render(monkeypatch, lambda: render_waybill_pdf_fast(payload))
+    start = drawn.index("Откуда: Главный склад") + 1
+    to_lines = drawn[start:drawn.index(f"Дата: {payload['created_at']}")]
+    assert len(to_lines) > 1
+    assert " ".join(to_lines) == f"Куда: {payload['to_branch'].strip()}"
+    assert all(waybill_pdf._SW(line) <= waybill_pdf._TEXT_W for line in to_lines)
+
+
+def _table_rows(monkeypatch, render):
+    """Run ``render`` and return the waybill table rows as plain text."""
+    tables = []
+    build = waybill_pdf.SimpleDocTemplate.build
+
+    def spy(doc, story, *args, **kwargs):
+        tables.extend(f for f in story if isinstance(f, Table))
+        return build(doc, story, *args, **kwargs)
+
+    monkeypatch.setattr(waybill_pdf.SimpleDocTemplate, "build", spy)
+    render()
+    (table,) = tables
+    return [
+        [c.getPlainText() if isinstance(c, Paragraph) else c for c in row]
+        for row in table._cellvalues
+    ]
+
+
+def _fast_render(monkeypatch, render):
+    """Run ``render`` and return the PDF and the canvas text, line by line."""
+    drawn = []
+
+    def record(y, text):
+        if drawn and drawn[-1][0] == y:
+            drawn[-1][1] += text
+        else:
+            drawn.append([y, text])
+
+    class RecordingCanvas(waybill_pdf.Canvas):
+        def drawString(self, x, y, text, *args, **kwargs):
+            record(y, text)
+            return super().drawString(x, y, text, *args, **kwargs)
+
+        def drawCentredString(self, x, y, text, *args, **kwargs):
+            record(y, text)
+            return super().drawCentredString(x, y, text, *args, **kwargs)
+
+    monkeypatch.setattr(waybill_pdf, "Canvas", RecordingCanvas)
+    pdf = render()
+    return pdf, [text for _, text in drawn]
+
+
+def _page_count(pdf):
+    return len(re.findall(rb"/Type /Page\b(?!s)", pdf))
+
+
+def _stable(pdf):
+    """Strip the per-render timestamps and document id from a PDF."""
+    return re.sub(rb"/(CreationDate|ModDate) \(D:[^)]*\)|/ID\s*\[[^\]]*\]", b"", pdf)
+
+
+def _render_bytes(payload):
+    buf = BytesIO()
+    render_waybill_pdf_to(payload, buf)
+    return buf.getvalue()
+
+
+def test_render_waybill_pdfs_in_process_pool(monkeypatch):
+    base = load_waybill_payload(SessionLocal(), "s1")
+    payloads = [dict(base, id=f"s{i}") for i in range(9)]
+    pools = []
+
+    class RecordingPool(waybill_pdf.ProcessPoolExecutor):
+        def __init__(self, max_workers=None, **kwargs):
+            pools.append(max_workers)
+            super().__init__(max_workers=max_workers, **kwargs)
+
+    monkeypatch.setattr(waybill_pdf, "ProcessPoolExecutor", RecordingPool)
+    waybill_pdf._CACHE.clear()
+    pdfs = render_waybill_pdfs(payloads, max_workers=2)
+    assert pools == [2]
+    expected = [_stable(_render_bytes(p)) for p in payloads]
+    assert len(set(expected)) == len(payloads)
+    assert [_stable(pdf) for pdf in pdfs] == expected
+
+
+def test_render_waybill_pdfs_serial_fallback(monkeypatch):
+    base = load_waybill_payload(SessionLocal(), "s1")
+    payloads = [dict(base, id=f"s{i}") for i in range(3)]
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("process pool used")
+
+    monkeypatch.setattr(waybill_pdf, "ProcessPoolExecutor", no_pool)
+    assert render_waybill_pdfs([]) == []
+    assert render_waybill_pdfs(payloads[:1]) == [render_waybill_pdf(payloads[0])]
+    assert render_waybill_pdfs(payloads, max_workers=1) == [
+        render_waybill_pdf(p) for p in payloads
+    ]
+
+
+def test_render_waybill_pdf_fast_paginates(monkeypatch):
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    # 124 rows end the table at the foot of page three, so the footer breaks too.
+    payload["items"] = [{"name": f"item {i}", "quantity": 2} for i in range(1, 125)]
+    payload["total_quantity"] = 248
+    pdf, drawn = _fast_render(monkeypatch, lambda: render_waybill_pdf_fast(payload))
+    assert _page_count(pdf) == 4
+    last_row = next(i for i, line in enumerate(drawn) if "item 124" in line)
+    totals = drawn.index("Всего позиций: 124, Всего единиц: 248")
+    assert last_row < totals
+    assert drawn[-1].startswith("Принял:")
+
+
+def test_render_waybill_pdf_soa_matches_dict_api(monkeypatch):
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    items = payload.pop("items")
+    soa_rows = _table_rows(
+        monkeypatch,
+        lambda: render_waybill_pdf_soa(
+            payload, [r["name"] for r in items], [r["quantity"] for r in items]
+        ),
+    )
+    dict_rows = _table_rows(
+        monkeypatch,
+        lambda: render_waybill_pdf_to(dict(payload, items=items), BytesIO()),
+    )
+    assert soa_rows == dict_rows
+    assert soa_rows[1:] == [["1", "Тримол", "шт", "20"], ["2", "Шприц 100", "шт", "15"]]
+
+
+def test_render_waybill_pdf_soa_length_mismatch():
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    with pytest.raises(ValueError):
+        render_waybill_pdf_soa(payload, ["a", "b", "c"], [1])
+
+
+def test_render_waybill_pdf_literal_names():
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    payload["items"][0]["name"] = "Шприц <5мл & <b>"
+    buf = BytesIO()
+    render_waybill_pdf_to(payload, buf)
+    assert buf.getvalue().startswith(b"%PDF")
+
+
+def test_render_waybill_pdf_concurrent():
+    payload = load_waybill_payload(SessionLocal(), "s1")
+
+    def render(_):
+        buf = BytesIO()
+        render_waybill_pdf_to(payload, buf)
+        return buf.getvalue()
+
+    with ThreadPoolExecutor(4) as pool:
+        pdfs = list(pool.map(render, range(8)))
+    assert all(pdf.startswith(b"%PDF") for pdf in pdfs)
+
+
+def test_render_waybill_pdf_is_cached_by_content():
+    payload = load_waybill_payload(SessionLocal(), "s1")
+    first = render_waybill_pdf(payload)
+    assert render_waybill_pdf(dict(payload)) is first
+    payload["to_branch"] = "B2"
+    assert render_waybill_pdf(payload) is not first
+
+
+def _create_shipment(monkeypatch, prerender=True):
+    monkeypatch.setattr(main, "SessionLocal", SessionLocal)
+    monkeypatch.setattr(main, "WAYBILL_PRERENDER", prerender)
+    tasks = BackgroundTasks()
+    resp = asyncio.run(main.create_shipment({"to_branch_id": "b1"}, tasks, db=session))
+    return resp, tasks
+
+
+def test_create_shipment_skips_prerender_by_default(monkeypatch):
+    _, tasks = _create_shipment(monkeypatch, prerender=False)
+    assert tasks.tasks == []
+
+
+def test_create_shipment_prerenders_waybill(monkeypatch):
+    waybill_pdf._CACHE.clear()
+    _, tasks = _create_shipment(monkeypatch)
+    asyncio.run(tasks())
+    shipment_id = session.execute(
+        select(Shipment.id).where(Shipment.id != "s1")
+    ).scalar_one()
+    before = (waybill_pdf._CACHE.hits, waybill_pdf._CACHE.misses)
+    resp = main.download_shipment_waybill(shipment_id, format="pdf", db=session)
+    after = (waybill_pdf._CACHE.hits, waybill_pdf._CACHE.misses)
+    assert resp.body.startswith(b"%PDF")
+    assert after == (before[0] + 1, before[1])
+
+
+def test_create_shipment_prerender_failure_is_logged(monkeypatch, caplog):
+    def broken(payload):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(main, "render_waybill_pdf", broken)
+    resp, tasks = _create_shipment(monkeypatch)
+    asyncio.run(tasks())
+    assert resp == {"message": "Shipment created successfully"}
+    assert "waybill prerender failed" in caplog.text
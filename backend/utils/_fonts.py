@@ -0,0 +1,27 @@
+from __future__ import annotations
+
+import os
+from functools import lru_cache
+from typing import Iterable
+
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+
+@lru_cache(maxsize=None)
+def ensure_font(name: str, path: str) -> str:
+    """Register the TTF font at ``path`` as ``name`` once per process."""
+    if name not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(name, path))
+    return name
+
+
+def first_available_font(name: str, candidates: Iterable[str], fallback: str) -> str:
+    """Register the first usable candidate as ``name``; ``fallback`` if none work."""
+    for path in candidates:
+        if os.path.exists(path):
+            try:
+                return ensure_font(name, path)
+            except Exception:
+                pass
+    return fallback
@@ -0,0 +1,14 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+
+@lru_cache(maxsize=None)
+def tz(name: str) -> ZoneInfo:
+    """Return the process-wide ZoneInfo for ``name``."""
+    return ZoneInfo(name)
+
+
+ALMATY = tz("Asia/Almaty")
+UTC = tz("UTC")
@@ -1,17 +1,29 @@
 from __future__ import annotations
 
+import html
 
-def render_waybill_html(p: dict) -> str:
+from utils.waybill_types import WaybillPayload
+
+
+def render_waybill_html(p: WaybillPayload) -> str:
     # Minimal, print-friendly HTML. Uses system fonts; good Cyrillic in browser.
-    items_rows = "\n".join(
-        f"<tr><td style='text-align:center'>{i+1}</td><td>{r['name']}</td><td style='text-align:center'>шт</td><td style='text-align:center'>{r['quantity']}</td></tr>"
-        for i, r in enumerate(p["items"])
-    )
+    esc = html.escape
+    pid, from_b, to_b = esc(str(p["id"])), esc(p["from_branch"]), esc(p["to_branch"])
+    created = esc(p["created_at"])
+    items = p["items"]
+    n = len(items)
+    total = p.get("total_quantity")
+    if total is None:
+        total = sum(r["quantity"] for r in items)
+    items_rows = "\n".join([
+        f"<tr><td style='text-align:center'>{i}</td><td>{esc(r['name'])}</td><td style='text-align:center'>шт</td><td style='text-align:center'>{r['quantity']}</td></tr>"
+        for i, r in enumerate(items, start=1)
+    ])
     return f"""<!doctype html>
 <html lang=\"ru\">
 <head>
   <meta charset=\"utf-8\"/>
-  <title>Накладная № {p['id']}</title>
+  <title>Накладная № {pid}</title>
   <style>
     body {{ font-family: system-ui, -apple-system, Segoe UI, Roboto, Arial, \"Noto Sans\", \"DejaVu Sans\", sans-serif; margin: 32px; }}
     h1 {{ font-size: 20px; margin: 0 0 12px; }}
@@ -29,11 +41,11 @@ def render_waybill_html(p: dict) -> str:
   </style>
 </head>
 <body>
-  <h1>Накладная № {p['id']}</h1>
+  <h1>Накладная № {pid}</h1>
   <div class=\"meta\">
-    <div><b>Откуда:</b> {p['from_branch']}</div>
-    <div><b>Куда:</b> {p['to_branch']}</div>
-    <div><b>Дата:</b> {p['created_at']}</div>
+    <div><b>Откуда:</b> {from_b}</div>
+    <div><b>Куда:</b> {to_b}</div>
+    <div><b>Дата:</b> {created}</div>
   </div>
 
   <table>
@@ -50,7 +62,7 @@ def render_waybill_html(p: dict) -> str:
     </tbody>
   </table>
 
-  <div class=\"meta\"><b>Всего позиций:</b> {len(p['items'])}, <b>Всего единиц:</b> {p['total_quantity']}</div>
+  <div class=\"meta\"><b>Всего позиций:</b> {n}, <b>Всего единиц:</b> {total}</div>
 
   <div class=\"sign\">
     <div class=\"sign-row\"><span>Отпустил:</span><div class=\"line\"></div><span>Подпись:</span><div class=\"line\" style=\"max-width:120px\"></div></div>
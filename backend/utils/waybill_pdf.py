@@ -1,32 +1,53 @@
 from __future__ import annotations
 
+import hashlib
+import json
 import os
+import threading
+from copy import copy
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
+from typing import BinaryIO, List, Optional, Sequence, Tuple
+
+from reportlab import rl_config
+
+# Shape validation, deterministic output and verbose logging are debugging
+# aids; some modules read these at import, so set them before other imports.
+if not os.environ.get("WAYBILL_DEBUG"):
+    rl_config.shapeChecking = 0
+    rl_config.invariant = 0
+    rl_config.verbose = 0
 
 from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
+from reportlab.lib.enums import TA_LEFT
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+from reportlab.lib.utils import simpleSplit
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import (
+    Flowable,
+    Paragraph,
+    SimpleDocTemplate,
+    Spacer,
+    Table,
+    TableStyle,
+)
+
+from utils._fonts import first_available_font
+from utils.waybill_types import WaybillHeader, WaybillPayload
 
 # Try find system fonts with Cyrillic support (do not add binaries to repo)
-_FONT_NAME = "Helvetica"
 _CANDIDATES = [
     "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
     "/usr/local/share/fonts/DejaVuSans.ttf",
     "C:\\Windows\\Fonts\\arial.ttf",
 ]
-
-for path in _CANDIDATES:
-    if os.path.exists(path):
-        try:
-            pdfmetrics.registerFont(TTFont("WaybillCyr", path))
-            _FONT_NAME = "WaybillCyr"
-            break
-        except Exception:
-            pass
+_FONT_NAME = first_available_font("WaybillCyr", _CANDIDATES, "Helvetica")
+# Width of 10pt table text, the size used by every waybill cell.
+_SW = partial(stringWidth, fontName=_FONT_NAME, fontSize=10)
 
 _styles = getSampleStyleSheet()
 TITLE = ParagraphStyle(
@@ -52,79 +73,327 @@ CELL = ParagraphStyle(
     fontSize=10,
     leading=12,
 )
-CELL_CENTER = ParagraphStyle(
-    "CELL_CENTER",
-    parent=CELL,
-    alignment=TA_CENTER,
-)
+_TABLE_STYLE = TableStyle([
+    ("FONTNAME", (0, 0), (-1, -1), _FONT_NAME),
+    ("FONTSIZE", (0, 0), (-1, -1), 10),
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.black),
+    ("BACKGROUND", (0, 0), (-1, 0), colors.whitesmoke),
+    ("ALIGN", (0, 0), (-1, 0), "CENTER"),
+    ("ALIGN", (0, 1), (0, -1), "CENTER"),
+    ("ALIGN", (2, 1), (3, -1), "CENTER"),
+    ("LEFTPADDING", (0, 0), (0, -1), 2),
+    ("RIGHTPADDING", (0, 0), (0, -1), 2),
+    ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+])
+
+# Short cells are plain strings drawn with the table font; only item names
+# stay Paragraphs so long names can wrap.
+_THEAD = [["№", "Наименование", "Ед.", "Кол-во"]]
+
+# Invariant flowables, parsed once. Flowables keep layout and canvas state on
+# the instance while drawing, so each render works on shallow copies.
+_SIGNATURES = [
+    Spacer(1, 16),
+    Paragraph(
+        "Отпустил: ______________________________  Подпись: ____________",
+        LABEL,
+    ),
+    Spacer(1, 6),
+    Paragraph(
+        "Принял:   ______________________________  Подпись: ____________",
+        LABEL,
+    ),
+]
+
+
+# Label markup is parsed once; each render clones the frags and substitutes
+# the values for _SLOT, so values are never run through the markup parser.
+# Item names reuse a single plain CELL frag the same way.
+_SLOT = "{}"
+_TITLE_FRAGS = Paragraph(f"Накладная № {_SLOT}", TITLE).frags
+_FROM_FRAGS = Paragraph(f"<b>Откуда:</b> {_SLOT}", LABEL).frags
+_TO_FRAGS = Paragraph(f"<b>Куда:</b> {_SLOT}", LABEL).frags
+_DATE_FRAGS = Paragraph(f"<b>Дата:</b> {_SLOT}", LABEL).frags
+_NAME_FRAG = Paragraph(_SLOT, CELL).frags[0]
+_TOTALS_FRAGS = Paragraph(
+    f"<b>Всего позиций:</b> {_SLOT}, <b>Всего единиц:</b> {_SLOT}", LABEL
+).frags
+
+
+def _filled(template: list, style: ParagraphStyle, *values: object) -> Paragraph:
+    values_iter = iter(values)
+    frags = [
+        f.clone(text=f.text.replace(_SLOT, str(next(values_iter)), 1))
+        if _SLOT in getattr(f, "text", "")
+        else f
+        for f in template
+    ]
+    return Paragraph("", style, frags=frags)
+
+
+# ASCII letters, digits, "-" and "_" are kept; every other ASCII char becomes "_".
+_SAFE_TRANS = str.maketrans({
+    chr(c): "_" for c in range(128) if not (chr(c).isalnum() or chr(c) in "-_")
+})
+
+
+def safe_filename(id_: object) -> str:
+    """Make an id usable inside a Content-Disposition filename."""
+    sanitized = str(id_).translate(_SAFE_TRANS)
+    if not sanitized.isascii():
+        sanitized = "".join(c if c.isascii() else "_" for c in sanitized)
+    return sanitized or "_"
+
+
+class _PdfCache:
+    """Thread-safe LRU of rendered PDFs, bounded by entry count and bytes."""
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self._data: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            pdf = self._data.get(key)
+            if pdf is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return pdf
+
+    def put(self, key: str, pdf: bytes) -> None:
+        if len(pdf) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._data[key] = pdf
+            self._size += len(pdf)
+            while len(self._data) > self.max_entries or self._size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+            self.hits = self.misses = 0
+
+
+_CACHE = _PdfCache(max_entries=256, max_bytes=32 * 1024 * 1024)
+
+
+def render_waybill_pdf(p: WaybillPayload) -> bytes:
+    # Issued waybills do not change, so identical payloads (reprints,
+    # repeated downloads) are served from the cache without ReportLab.
+    # default=str only shapes the key; a miss renders the caller's payload.
+    key = hashlib.blake2b(
+        json.dumps(p, sort_keys=True, default=str).encode(), digest_size=16
+    ).hexdigest()
+    pdf = _CACHE.get(key)
+    if pdf is None:
+        pdf = _render(p)
+        _CACHE.put(key, pdf)
+    return pdf
+
+
+def _render(p: WaybillPayload) -> bytes:
+    if not p["items"]:
+        # Nothing to lay out in the table, so skip Platypus entirely.
+        return render_waybill_pdf_fast(p)
+    buf = BytesIO()
+    render_waybill_pdf_to(p, buf)
+    return buf.getvalue()
 
 
-def render_waybill_pdf(p: dict) -> bytes:
+def render_waybill_pdfs(
+    payloads: Sequence[WaybillPayload], max_workers: Optional[int] = None
+) -> List[bytes]:
+    """Render many waybills in worker processes, preserving input order."""
+    workers = min(max_workers or os.cpu_count() or 1, len(payloads))
+    if workers < 2:
+        return [render_waybill_pdf(p) for p in payloads]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(render_waybill_pdf, payloads, chunksize=4))
+
+
+def _total(p: WaybillHeader, quantities: Sequence[int]) -> int:
+    total = p.get("total_quantity")
+    return sum(quantities) if total is None else total
+
+
+def render_waybill_pdf_to(p: WaybillPayload, fp: BinaryIO) -> None:
+    """Render the waybill straight into a writable binary file object."""
+    items = p["items"]
+    _render_columns(
+        p, [r["name"] for r in items], [r["quantity"] for r in items], fp
+    )
+
+
+def render_waybill_pdf_soa(
+    header: WaybillHeader, names: Sequence[str], quantities: Sequence[int]
+) -> bytes:
+    """Render a waybill whose rows are given as parallel name/quantity lists.
+
+    ``header`` carries the payload fields other than ``items``. Raises
+    ValueError if ``names`` and ``quantities`` differ in length.
+    """
+    if len(names) != len(quantities):
+        raise ValueError(
+            f"{len(names)} names but {len(quantities)} quantities"
+        )
     buf = BytesIO()
+    _render_columns(header, names, quantities, buf)
+    return buf.getvalue()
+
+
+def _render_columns(
+    p: WaybillHeader, names: Sequence[str], quantities: Sequence[int], fp: BinaryIO
+) -> None:
     doc = SimpleDocTemplate(
-        buf,
+        fp,
         pagesize=A4,
         leftMargin=28,
         rightMargin=28,
         topMargin=28,
         bottomMargin=28,
     )
-    story = []
+    story: List[Flowable] = []
 
-    story.append(Paragraph(f"Накладная № {p['id']}", TITLE))
-    story.append(Paragraph(f"<b>Откуда:</b> {p['from_branch']}", LABEL))
-    story.append(Paragraph(f"<b>Куда:</b> {p['to_branch']}", LABEL))
-    story.append(Paragraph(f"<b>Дата:</b> {p['created_at']}", LABEL))
+    story.append(_filled(_TITLE_FRAGS, TITLE, p["id"]))
+    story.append(_filled(_FROM_FRAGS, LABEL, p["from_branch"]))
+    story.append(_filled(_TO_FRAGS, LABEL, p["to_branch"]))
+    story.append(_filled(_DATE_FRAGS, LABEL, p["created_at"]))
     story.append(Spacer(1, 10))
 
-    thead = [[
-        Paragraph("№", CELL_CENTER),
-        Paragraph("Наименование", CELL),
-        Paragraph("Ед.", CELL_CENTER),
-        Paragraph("Кол-во", CELL_CENTER),
-    ]]
-    body = []
-    for i, r in enumerate(p["items"], start=1):
-        body.append([
-            Paragraph(str(i), CELL_CENTER),
-            Paragraph(r["name"], CELL),
-            Paragraph("шт", CELL_CENTER),
-            Paragraph(str(r["quantity"]), CELL_CENTER),
-        ])
-    tbl = Table(thead + body, colWidths=[22, 350, 40, 60])
-    tbl.setStyle(
-        TableStyle([
-            ("FONTNAME", (0, 0), (-1, -1), _FONT_NAME),
-            ("FONTSIZE", (0, 0), (-1, -1), 10),
-            ("GRID", (0, 0), (-1, -1), 0.5, colors.black),
-            ("BACKGROUND", (0, 0), (-1, 0), colors.whitesmoke),
-            ("ALIGN", (0, 0), (-1, 0), "CENTER"),
-            ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
-        ])
-    )
+    para, cell, name_frag = Paragraph, CELL, _NAME_FRAG.clone
+    body = [
+        [str(i), para("", cell, frags=[name_frag(text=name)]), "шт", str(qty)]
+        for i, (name, qty) in enumerate(zip(names, quantities), start=1)
+    ]
+    # With no wrapping names every row is one line high, so pass the heights
+    # and let Table skip measuring each cell.
+    row_heights: Optional[List[float]] = None
+    if all(_SW(name) <= _NAME_W for name in names):
+        row_heights = [_ROW_H] * (len(body) + 1)
+    tbl = Table(_THEAD + body, colWidths=list(_COL_WIDTHS), rowHeights=row_heights)
+    tbl.setStyle(_TABLE_STYLE)
     story.append(tbl)
 
     story.append(Spacer(1, 12))
     story.append(
-        Paragraph(
-            f"<b>Всего позиций:</b> {len(p['items'])}, <b>Всего единиц:</b> {p['total_quantity']}",
-            LABEL,
-        )
-    )
-    story.append(Spacer(1, 16))
-    story.append(
-        Paragraph(
-            "Отпустил: ______________________________  Подпись: ____________",
-            LABEL,
-        )
-    )
-    story.append(Spacer(1, 6))
-    story.append(
-        Paragraph(
-            "Принял:   ______________________________  Подпись: ____________",
-            LABEL,
-        )
+        _filled(_TOTALS_FRAGS, LABEL, len(body), _total(p, quantities))
     )
+    story.extend(copy(f) for f in _SIGNATURES)
 
     doc.build(story)
+
+
+# Fixed geometry for the canvas renderer; mirrors the Platypus layout above.
+_PAGE_W, _PAGE_H = A4
+_MARGIN = 28
+_COL_WIDTHS = (22, 350, 40, 60)
+_COL_X = [_MARGIN + (_PAGE_W - 2 * _MARGIN - sum(_COL_WIDTHS)) / 2]
+for _w in _COL_WIDTHS:
+    _COL_X.append(_COL_X[-1] + _w)
+_TABLE_W = _COL_X[-1] - _COL_X[0]
+_CELL_PAD = 6
+_CELL_LEADING = 12
+_ROW_H = 10 * 1.2 + 6  # one 10pt line plus the default 3pt top/bottom padding
+_NAME_W = _COL_WIDTHS[1] - 2 * _CELL_PAD
+_TEXT_W = _PAGE_W - 2 * _MARGIN - 12  # Platypus frames pad 6pt per side
+
+
+def render_waybill_pdf_fast(p: WaybillPayload) -> bytes:
+    """Render the waybill with direct canvas calls, skipping Platypus layout."""
+    buf = BytesIO()
+    c = Canvas(buf, pagesize=A4)
+    y = _PAGE_H - _MARGIN
+
+    # Header mirrors the TITLE and LABEL paragraphs, wrapped at frame width.
+    y += 4
+    c.setFont(_FONT_NAME, 18)
+    for line in simpleSplit(f"Накладная № {p['id']}", _FONT_NAME, 18, _TEXT_W):
+        y -= 22
+        c.drawString(_MARGIN, y, line)
+    y -= 12
+    c.setFont(_FONT_NAME, 10)
+    for label in (
+        f"Откуда: {p['from_branch']}",
+        f"Куда: {p['to_branch']}",
+        f"Дата: {p['created_at']}",
+    ):
+        for line in simpleSplit(label, _FONT_NAME, 10, _TEXT_W):
+            y -= 13
+            c.drawString(_MARGIN, y, line)
+    y -= 10
+
+    rows: List[Tuple[str, List[str], str, str]] = [
+        ("№", ["Наименование"], "Ед.", "Кол-во")
+    ]
+    items = p["items"]
+    total = 0
+    for i, r in enumerate(items, start=1):
+        name, qty = r["name"], r["quantity"]
+        total += qty
+        if _SW(name) <= _NAME_W:
+            name_lines = [name]
+        else:
+            name_lines = simpleSplit(name, _FONT_NAME, 10, _NAME_W) or [""]
+        rows.append((str(i), name_lines, "шт", str(qty)))
+    if p.get("total_quantity") is not None:
+        total = p["total_quantity"]
+
+    c.setLineWidth(0.5)
+    # Row boundaries on the current page; the grid is stroked in one go
+    # per page instead of per row.
+    ys: List[float] = [y]
+    for n, (num, name_lines, unit, qty) in enumerate(rows):
+        h = len(name_lines) * _CELL_LEADING + 6
+        if y - h < _MARGIN:
+            c.grid(_COL_X, ys)
+            c.showPage()
+            c.setFont(_FONT_NAME, 10)
+            c.setLineWidth(0.5)
+            y = _PAGE_H - _MARGIN
+            ys = [y]
+        bottom = y - h
+        ys.append(bottom)
+        if n == 0:
+            c.setFillColor(colors.whitesmoke)
+            c.rect(_COL_X[0], bottom, _TABLE_W, h, stroke=0, fill=1)
+            c.setFillColor(colors.black)
+
+        mid = bottom + h / 2 - 3.5
+        c.drawCentredString((_COL_X[0] + _COL_X[1]) / 2, mid, num)
+        top = mid + (len(name_lines) - 1) * _CELL_LEADING / 2
+        for k, line in enumerate(name_lines):
+            if n == 0:
+                c.drawCentredString((_COL_X[1] + _COL_X[2]) / 2, top, line)
+            else:
+                c.drawString(_COL_X[1] + _CELL_PAD, top - k * _CELL_LEADING, line)
+        c.drawCentredString((_COL_X[2] + _COL_X[3]) / 2, mid, unit)
+        c.drawCentredString((_COL_X[3] + _COL_X[4]) / 2, mid, qty)
+        y = bottom
+    c.grid(_COL_X, ys)
+
+    for gap, line in (
+        (12, f"Всего позиций: {len(items)}, Всего единиц: {total}"),
+        (16, "Отпустил: ______________________________  Подпись: ____________"),
+        (6, "Принял:   ______________________________  Подпись: ____________"),
+    ):
+        y -= gap + 13
+        if y < _MARGIN:
+            c.showPage()
+            c.setFont(_FONT_NAME, 10)
+            y = _PAGE_H - _MARGIN - 13
+        c.drawString(_MARGIN, y, line)
+
+    c.save()
     return buf.getvalue()
@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+from typing import List, TypedDict
+
+
+class WaybillItem(TypedDict):
+    name: str
+    quantity: int
+
+
+class _WaybillHeaderFields(TypedDict):
+    id: str
+    created_at: str
+    from_branch: str
+    to_branch: str
+
+
+class WaybillHeader(_WaybillHeaderFields, total=False):
+    """Waybill fields other than the item rows.
+
+    ``total_quantity`` is summed from the rows when omitted.
+    """
+
+    total_quantity: int
+
+
+class WaybillPayload(WaybillHeader):
+    items: List[WaybillItem]